@@ -1,16 +1,20 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-import io
+from fastapi.responses import Response
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints
 import os
+import json
+import sys
 import logging
-from typing import Optional
+from typing import Annotated, Literal, Optional
 import gc
 import asyncio
+import hashlib
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 import psutil
 from google.cloud import texttospeech
+from google.cloud.texttospeech_v1.services.text_to_speech.transports import TextToSpeechGrpcAsyncIOTransport
 from google.auth.exceptions import DefaultCredentialsError
 
 # Configure logging
@@ -23,11 +27,60 @@ logger = logging.getLogger(__name__)
 # Global variable to store TTS service
 tts_service = None
 
+# Number of synthesized clips kept in memory for repeated requests (0 disables the cache)
+AUDIO_CACHE_SIZE = int(os.getenv("TTS_CACHE_SIZE", 64))
+
+# Text length limit - increased from 500 to handle longer summaries
+MAX_TEXT_LENGTH = 1000
+
+# Control characters removed from input text (tab and newline are kept)
+CONTROL_CHARS = dict.fromkeys([*range(32), 127])
+del CONTROL_CHARS[ord("\t")], CONTROL_CHARS[ord("\n")]
+
+# gRPC channel shared by all synthesis calls - keepalive avoids TCP/TLS re-handshakes between bursts
+TTS_API_ENDPOINT = "texttospeech.googleapis.com:443"
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.use_local_subchannel_pool", 1)
+]
+
+# Supported output formats - Opus is roughly half the size of MP3 at comparable speech quality
+DEFAULT_AUDIO_FORMAT = "opus"
+AUDIO_FORMATS = {
+    "opus": {
+        "encoding": texttospeech.AudioEncoding.OGG_OPUS,
+        "media_type": "audio/ogg; codecs=opus",
+        "extension": "ogg"
+    },
+    "mp3": {
+        "encoding": texttospeech.AudioEncoding.MP3,
+        "media_type": "audio/mpeg",
+        "extension": "mp3"
+    }
+}
+
+# Handle to this worker process, reused by every memory reading
+process = psutil.Process(os.getpid())
+
 def get_memory_usage():
     """Get current memory usage in MB"""
-    process = psutil.Process(os.getpid())
     return process.memory_info().rss / 1024 / 1024
 
+def get_proportional_memory_usage():
+    """Get proportional set size in MB (shared pages split across workers), or None where unsupported"""
+    try:
+        pss = getattr(process.memory_full_info(), "pss", None)
+    except psutil.Error:
+        return None
+    return pss / 1024 / 1024 if pss is not None else None
+
+def sanitize_text(text: str) -> str:
+    """Strip control characters and surrounding whitespace in a single pass"""
+    return text.translate(CONTROL_CHARS).strip()
+
 def verify_google_credentials():
     """Verify Google Cloud credentials are properly configured"""
     credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
@@ -54,6 +107,7 @@ async def lifespan(app: FastAPI):
         verify_google_credentials()
         
         tts_service = TTSService()
+        await tts_service.warmup()
         logger.info(f"TTS Service initialized - Memory usage: {get_memory_usage():.1f}MB")
     except ValueError as e:
         logger.error(f"Credentials error: {str(e)}")
@@ -76,6 +130,7 @@ async def lifespan(app: FastAPI):
     if tts_service:
         logger.info("Cleaning up TTS Service...")
         tts_service.cleanup()
+        await tts_service.close()
 
 app = FastAPI(
     title="Google Cloud TTS Microservice",
@@ -104,113 +159,183 @@ app.add_middleware(
     max_age=3600
 )
 
+# Define available voices with their properties - Updated to match frontend expectations
+AVAILABLE_VOICES = {
+    "en-US-Standard-C": {
+        "language_code": "en-US",
+        "name": "en-US-Standard-C",
+        "ssml_gender": texttospeech.SsmlVoiceGender.FEMALE,
+        "description": "Standard female voice"
+    },
+    "en-GB-Standard-B": {
+        "language_code": "en-GB",
+        "name": "en-GB-Standard-B",
+        "ssml_gender": texttospeech.SsmlVoiceGender.MALE,
+        "description": "British male voice"
+    },
+    # Additional voices for better variety
+    "en-US-Wavenet-D": {
+        "language_code": "en-US",
+        "name": "en-US-Wavenet-D",
+        "ssml_gender": texttospeech.SsmlVoiceGender.MALE,
+        "description": "WaveNet male voice (deep)"
+    },
+    "en-GB-Standard-A": {
+        "language_code": "en-GB",
+        "name": "en-GB-Standard-A",
+        "ssml_gender": texttospeech.SsmlVoiceGender.FEMALE,
+        "description": "British female voice"
+    },
+    "en-AU-Standard-A": {
+        "language_code": "en-AU",
+        "name": "en-AU-Standard-A",
+        "ssml_gender": texttospeech.SsmlVoiceGender.FEMALE,
+        "description": "Australian female voice"
+    }
+}
+
 class TTSRequest(BaseModel):
-    text: str
-    voice: Optional[str] = "en-US-Standard-C"
-    speed: Optional[float] = 1.0
-    pitch: Optional[float] = 0.0
+    # Reject malformed requests up front so generate_speech doesn't re-validate them
+    model_config = ConfigDict(extra="forbid", frozen=True)
+    
+    text: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=MAX_TEXT_LENGTH)]
+    voice: Literal[tuple(AVAILABLE_VOICES)] = "en-US-Standard-C"
+    speed: Annotated[float, Field(ge=0.25, le=4.0)] = 1.0
+    pitch: Annotated[float, Field(ge=-20.0, le=20.0)] = 0.0
+    output_format: Literal[tuple(AUDIO_FORMATS)] = DEFAULT_AUDIO_FORMAT
 
 class TTSService:
     def __init__(self):
-        self.client = texttospeech.TextToSpeechClient()
+        # Async client on a pre-built channel so concurrent requests multiplex over one connection
+        self.channel = TextToSpeechGrpcAsyncIOTransport.create_channel(
+            TTS_API_ENDPOINT,
+            options=GRPC_CHANNEL_OPTIONS
+        )
+        self.client = texttospeech.TextToSpeechAsyncClient(
+            transport=TextToSpeechGrpcAsyncIOTransport(channel=self.channel)
+        )
         
-        # Define available voices with their properties - Updated to match frontend expectations
-        self.available_voices = {
-            "en-US-Standard-C": {
-                "language_code": "en-US",
-                "name": "en-US-Standard-C",
-                "ssml_gender": texttospeech.SsmlVoiceGender.FEMALE,
-                "description": "Standard female voice"
-            },
-            "en-GB-Standard-B": {
-                "language_code": "en-GB",
-                "name": "en-GB-Standard-B",
-                "ssml_gender": texttospeech.SsmlVoiceGender.MALE,
-                "description": "British male voice"
-            },
-            # Additional voices for better variety
-            "en-US-Wavenet-D": {
-                "language_code": "en-US",
-                "name": "en-US-Wavenet-D",
-                "ssml_gender": texttospeech.SsmlVoiceGender.MALE,
-                "description": "WaveNet male voice (deep)"
-            },
-            "en-GB-Standard-A": {
-                "language_code": "en-GB",
-                "name": "en-GB-Standard-A",
-                "ssml_gender": texttospeech.SsmlVoiceGender.FEMALE,
-                "description": "British female voice"
-            },
-            "en-AU-Standard-A": {
-                "language_code": "en-AU",
-                "name": "en-AU-Standard-A",
-                "ssml_gender": texttospeech.SsmlVoiceGender.FEMALE,
-                "description": "Australian female voice"
-            }
+        self.available_voices = AVAILABLE_VOICES
+        
+        # Build the voice request for each voice once instead of per synthesis
+        self.voice_params = {
+            voice_id: texttospeech.VoiceSelectionParams(
+                language_code=config["language_code"],
+                name=config["name"],
+                ssml_gender=config["ssml_gender"]
+            )
+            for voice_id, config in self.available_voices.items()
         }
         
+        # The voice list is static, so serialize the /voices payload once
+        voices = []
+        for voice_id, config in self.available_voices.items():
+            voices.append({
+                "id": voice_id,
+                "language_code": config["language_code"],
+                "name": config["name"],
+                "gender": config["ssml_gender"].name,  # Convert enum to string
+                "description": config["description"]
+            })
+        self.voices_json = json.dumps({"voices": voices}).encode("utf-8")
+        
+        # LRU cache of generated audio keyed by a hash of the synthesis inputs
+        self.audio_cache = OrderedDict()
+        # Synthesis tasks in flight, keyed like the cache, so identical requests share one upstream call
+        self.inflight = {}
+        
         logger.info(f"TTSService initialized - Memory: {get_memory_usage():.1f}MB")
     
-    def generate_speech(self, text: str, voice: str = "en-US-Standard-C", speed: float = 1.0, pitch: float = 0.0) -> bytes:
+    @staticmethod
+    def _cache_key(text: str, voice: str, speed: float, pitch: float, output_format: str) -> str:
+        """Build the audio cache key for a set of synthesis inputs"""
+        return hashlib.blake2b(f"{output_format}|{voice}|{speed}|{pitch}|{text}".encode("utf-8"), digest_size=16).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[bytes]:
+        """Return cached audio for key, marking it as recently used"""
+        audio = self.audio_cache.get(key)
+        if audio is not None:
+            self.audio_cache.move_to_end(key)
+        return audio
+    
+    def _cache_put(self, key: str, audio: bytes):
+        """Store audio for key, evicting the least recently used entries"""
+        if AUDIO_CACHE_SIZE <= 0:
+            return
+        self.audio_cache[key] = audio
+        self.audio_cache.move_to_end(key)
+        while len(self.audio_cache) > AUDIO_CACHE_SIZE:
+            self.audio_cache.popitem(last=False)
+    
+    async def warmup(self, timeout: float = 10.0):
+        """Open the gRPC connection and fetch an auth token ahead of the first request"""
+        try:
+            # A cheap ListVoices call primes both the channel and the OAuth token that channel_ready() alone skips
+            await asyncio.wait_for(self.client.list_voices(language_code="en-US"), timeout=timeout)
+            logger.info("Google Cloud TTS channel ready")
+        except Exception as e:
+            logger.warning(f"Google Cloud TTS channel warmup failed: {str(e)}")
+    
+    def _finish_inflight(self, key: str, task: asyncio.Future):
+        """Cache a finished synthesis and stop sharing its task"""
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self._cache_put(key, task.result())
+    
+    async def _synthesize(self, text: str, voice: str, speed: float, pitch: float, output_format: str) -> bytes:
+        """Call Google Cloud TTS for already validated inputs"""
+        # Set the text input to be synthesized
+        synthesis_input = texttospeech.SynthesisInput(text=text)
+        
+        # Select the type of audio file - Opus by default, MP3 on request for older players
+        audio_config = texttospeech.AudioConfig(
+            audio_encoding=AUDIO_FORMATS[output_format]["encoding"],
+            speaking_rate=speed,
+            pitch=pitch
+        )
+        
+        # Perform the text-to-speech request
+        response = await self.client.synthesize_speech(
+            input=synthesis_input,
+            voice=self.voice_params[voice],
+            audio_config=audio_config
+        )
+        
+        logger.info(f"Successfully generated {len(response.audio_content)} bytes")
+        return response.audio_content
+    
+    async def generate_speech(self, text: str, voice: str = "en-US-Standard-C", speed: float = 1.0, pitch: float = 0.0, output_format: str = DEFAULT_AUDIO_FORMAT) -> bytes:
         """Generate speech using Google Cloud TTS"""
         try:
-            logger.info(f"Starting speech generation - Memory: {get_memory_usage():.1f}MB")
-            
-            # Input validation
-            if not text or not text.strip():
+            # Voice, ranges and length are validated by TTSRequest; text may still be only control characters
+            text = sanitize_text(text)
+            if not text:
                 raise HTTPException(status_code=400, detail="Text cannot be empty")
             
-            # Text length limit - increased for better summaries
-            max_length = 1000  # Increased from 500 to handle longer summaries
-            if len(text) > max_length:
-                text = text[:max_length]
-                logger.warning(f"Text truncated to {max_length} characters")
-            
-            text = text.strip()
-            
-            # Validate voice
-            if voice not in self.available_voices:
-                logger.warning(f"Invalid voice '{voice}', using en-US-Standard-C")
-                voice = "en-US-Standard-C"
-            
-            # Validate speed and pitch
-            speed = max(0.25, min(4.0, float(speed)))
-            pitch = max(-20.0, min(20.0, float(pitch)))
-            
-            # Get voice configuration
-            voice_config = self.available_voices[voice]
+            # Round speed and pitch so near-identical values share a cache entry
+            speed = round(speed, 2)
+            pitch = round(pitch, 2)
             
-            # Set the text input to be synthesized
-            synthesis_input = texttospeech.SynthesisInput(text=text)
+            # Serve repeated requests straight from the cache
+            cache_key = self._cache_key(text, voice, speed, pitch, output_format)
+            cached_audio = self._cache_get(cache_key)
+            if cached_audio is not None:
+                logger.info(f"Cache hit - returning {len(cached_audio)} bytes")
+                return cached_audio
             
-            # Build the voice request
-            voice_params = texttospeech.VoiceSelectionParams(
-                language_code=voice_config["language_code"],
-                name=voice_config["name"],
-                ssml_gender=voice_config["ssml_gender"]
-            )
-            
-            # Select the type of audio file - Changed to MP3 for better compression and compatibility
-            audio_config = texttospeech.AudioConfig(
-                audio_encoding=texttospeech.AudioEncoding.MP3,  # Changed from LINEAR16 to MP3
-                speaking_rate=speed,
-                pitch=pitch
-            )
+            # Identical in-flight requests share the first one's task, including its failure
+            task = self.inflight.get(cache_key)
+            if task is None:
+                task = asyncio.ensure_future(self._synthesize(text, voice, speed, pitch, output_format))
+                self.inflight[cache_key] = task
+                task.add_done_callback(lambda done: self._finish_inflight(cache_key, done))
             
-            # Perform the text-to-speech request
-            response = self.client.synthesize_speech(
-                input=synthesis_input,
-                voice=voice_params,
-                audio_config=audio_config
-            )
-            
-            logger.info(f"Successfully generated {len(response.audio_content)} bytes - Final memory: {get_memory_usage():.1f}MB")
-            
-            # Force garbage collection after generation
-            gc.collect()
-            
-            return response.audio_content
+            # Shield so one client disconnecting doesn't cancel the call for everyone waiting on it
+            return await asyncio.shield(task)
             
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Speech generation failed: {str(e)}")
             if "GOOGLE_APPLICATION_CREDENTIALS" in str(e):
@@ -226,13 +351,21 @@ class TTSService:
     def cleanup(self):
         """Cleanup resources"""
         try:
+            self.audio_cache.clear()
             gc.collect()
             logger.info("TTS Service cleaned up successfully")
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
+    
+    async def close(self):
+        """Close the gRPC channel"""
+        try:
+            await self.client.transport.close()
+        except Exception as e:
+            logger.error(f"Error closing TTS client: {e}")
 
 @app.get("/")
-async def root():
+async def root() -> dict:
     return {
         "message": "Google Cloud TTS Microservice is running",
         "version": "1.0.0",
@@ -245,42 +378,30 @@ async def get_available_voices():
     if not tts_service:
         raise HTTPException(status_code=503, detail="TTS service not initialized")
     
-    voices = []
-    for voice_id, config in tts_service.available_voices.items():
-        voices.append({
-            "id": voice_id,
-            "language_code": config["language_code"],
-            "name": config["name"],
-            "gender": config["ssml_gender"].name,  # Convert enum to string
-            "description": config["description"]
-        })
-    
-    return {"voices": voices}
+    return Response(content=tts_service.voices_json, media_type="application/json")
 
 @app.post("/generate-speech")
-async def generate_speech(request: TTSRequest, background_tasks: BackgroundTasks):
+async def generate_speech(request: TTSRequest):
     """Generate speech from text"""
     if not tts_service:
         raise HTTPException(status_code=503, detail="TTS service not initialized")
     
     try:
-        audio_data = tts_service.generate_speech(
+        audio_data = await tts_service.generate_speech(
             text=request.text,
             voice=request.voice,
             speed=request.speed,
-            pitch=request.pitch
+            pitch=request.pitch,
+            output_format=request.output_format
         )
         
-        # Add cleanup task
-        background_tasks.add_task(gc.collect)
-        
-        # Updated to return MP3 instead of WAV
-        return StreamingResponse(
-            io.BytesIO(audio_data),
-            media_type="audio/mpeg",  # Changed from audio/wav to audio/mpeg
+        audio_format = AUDIO_FORMATS[request.output_format]
+        # Audio is fully materialized, so send it in one shot; Content-Length is set automatically
+        return Response(
+            content=audio_data,
+            media_type=audio_format["media_type"],
             headers={
-                "Content-Disposition": "attachment; filename=speech.mp3",  # Changed extension
-                "Content-Length": str(len(audio_data)),
+                "Content-Disposition": f"attachment; filename=speech.{audio_format['extension']}",
                 "Cache-Control": "no-cache"  # Prevent caching issues
             }
         )
@@ -291,7 +412,7 @@ async def generate_speech(request: TTSRequest, background_tasks: BackgroundTasks
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
-async def health_check():
+async def health_check() -> dict:
     """Health check endpoint"""
     if not tts_service:
         return {
@@ -310,15 +431,16 @@ async def health_check():
     }
 
 @app.get("/memory")
-async def memory_info():
+async def memory_info() -> dict:
     """Get memory usage information"""
     return {
         "memory_usage_mb": get_memory_usage(),
+        "proportional_memory_mb": get_proportional_memory_usage(),
         "message": "Memory usage is monitored for optimization"
     }
 
 @app.post("/cleanup")
-async def force_cleanup():
+async def force_cleanup() -> dict:
     """Force cleanup of resources"""
     if not tts_service:
         raise HTTPException(status_code=503, detail="TTS service not initialized")
@@ -330,7 +452,7 @@ async def force_cleanup():
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.options("/generate-speech")
-async def options_generate_speech():
+async def options_generate_speech() -> dict:
     """Handle OPTIONS request for CORS"""
     return {}
 
@@ -347,12 +469,17 @@ async def service_unavailable_handler(request, exc):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    logger.info(f"Starting server on port {port}")
+    # Single worker by default like the uvicorn CLI; each extra worker adds its own gRPC channel and audio cache
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    logger.info(f"Starting server on port {port} with {workers} worker(s)")
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
-        workers=1,
+        workers=workers,
+        # uvloop is not available on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
         timeout_keep_alive=30,
         access_log=True
     )
\ No newline at end of file
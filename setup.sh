@@ -24,18 +24,13 @@ cd google-cloud-tts-service
 echo "📝 Creating requirements.txt..."
 cat > requirements.txt << 'EOF'
 # Core web framework dependencies
-fastapi
+fastapi>=0.100
 uvicorn[standard]
-pydantic
+pydantic>=2.1
 
 # Google Cloud TTS
 google-cloud-texttospeech
 
-# Minimal required dependencies
-numpy
-torch
-torchaudio
-
 # System monitoring
 psutil
 EOF
@@ -79,7 +74,7 @@ HEALTHCHECK --interval=30s --timeout=30s --start-period=60s --retries=3 \
     CMD curl -f http://localhost:8000/health || exit 1
 
 # Run the application
-CMD ["uvicorn", "main:app", "--host", "0.0.0.0", "--port", "8000"]
+CMD ["uvicorn", "main:app", "--host", "0.0.0.0", "--port", "8000", "--loop", "uvloop", "--http", "httptools"]
 EOF
 
 # Create render.yaml
@@ -95,7 +90,7 @@ services:
       pip install --no-cache-dir --upgrade pip setuptools wheel &&
       pip install --no-cache-dir -r requirements.txt
     # Simplified start command
-    startCommand: "uvicorn main:app --host 0.0.0.0 --port $PORT"
+    startCommand: "uvicorn main:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools"
     healthCheckPath: /health
     # Environment variables
     envVars:
@@ -103,6 +98,9 @@ services:
         value: "1"
       - key: PYTHONUNBUFFERED
         value: "1"
+      # Number of uvicorn worker processes (free plan has 0.5 vCPU)
+      - key: WEB_CONCURRENCY
+        value: "1"
       - key: GOOGLE_APPLICATION_CREDENTIALS
         value: "/etc/secrets/google-credentials.json"
 EOF